@@ -5,28 +5,173 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError, PyMongoError, WriteError
+import asyncio
+import logging
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
-from typing import Union
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar, Union
+from bson import ObjectId
 from pydantic import BaseModel
 
 # Load environment variables from .env file
 load_dotenv()
 
-_client = None
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+client = None
 db = None
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
+# One client per process; its pool is shared by every request
 if database_url and database_name:
-    _client = MongoClient(database_url)
-    db = _client[database_name]
+    client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=int(os.getenv("DATABASE_MAX_POOL_SIZE", "200")),
+        # zstd when the zstandard module is installed, zlib otherwise
+        compressors="zstd,zlib",
+        retryWrites=True,
+        w="majority",
+    )
+    db = client[database_name]
+
+async def connect() -> bool:
+    """Bind the client to the running event loop and ensure indexes (call from app startup).
+
+    Returns whether the database answered; callers skip startup work that needs it.
+    """
+    if db is None:
+        return False
+    try:
+        await db.command("ping")
+    except Exception:
+        # Connection errors surface on the first request, as before
+        return False
+    try:
+        await migrate_course_ids()
+    except PyMongoError:
+        logger.exception("Failed to migrate coursetoken course ids")
+    try:
+        await ensure_indexes()
+    except PyMongoError:
+        logger.exception("Failed to create indexes")
+    return True
+
+async def migrate_course_ids():
+    """Convert coursetoken.course_id values written as hex strings to ObjectId.
+
+    Values that are not valid ObjectId strings are left as they are.
+    """
+    await db.coursetoken.update_many(
+        {"course_id": {"$type": "string"}},
+        [{"$set": {"course_id": {
+            "$convert": {"input": "$course_id", "to": "objectId", "onError": "$course_id"}
+        }}}],
+    )
+
+async def ensure_indexes():
+    """Create the indexes backing the hot query shapes (no-op when they exist)"""
+    await asyncio.gather(
+        db.balance.create_index([("user_id", 1), ("course_id", 1)], unique=True),
+        # Equality filters followed by _id serve the keyset-paginated list queries
+        db.balance.create_index([("user_id", 1), ("_id", 1)]),
+        db.coursetoken.create_index([("course_id", 1)], unique=True),
+        db.order.create_index([("course_id", 1), ("side", 1), ("_id", 1)]),
+        db.purchase.create_index([("user_id", 1)]),
+    )
+
+def close():
+    """Close the client (call from app shutdown)"""
+    if client is not None:
+        client.close()
+
+class BulkWriter:
+    """Coalesces single-document writes to one collection into unordered bulk_writes.
+
+    Writes queued by concurrent requests within `interval` seconds (up to
+    `max_batch`) go out as one bulk_write; each caller awaits its own op.
+    """
+
+    def __init__(self, collection_name: str, interval: float = 0.001, max_batch: int = 500):
+        self.collection_name = collection_name
+        self.interval = interval
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def write(self, op):
+        """Queue a pymongo write op (InsertOne, UpdateOne, ...) and wait until it is persisted"""
+        if db is None:
+            raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, future))
+        await future
+
+    async def stop(self):
+        """Flush everything queued so far, then stop the writer"""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        self._task = None
+
+    async def _run(self):
+        while True:
+            batch: List[Tuple[object, asyncio.Future]] = [await self._queue.get()]
+            errors: Dict[int, Exception] = {}
+            written = False
+            try:
+                await asyncio.sleep(self.interval)
+                while len(batch) < self.max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                await db[self.collection_name].bulk_write([op for op, _ in batch], ordered=False)
+                written = True
+            except BulkWriteError as e:
+                # Unordered: every op without its own write error was applied
+                written = True
+                for err in e.details.get("writeErrors", []):
+                    errors[err["index"]] = WriteError(err.get("errmsg"), err.get("code"), err)
+                if e.details.get("writeConcernErrors"):
+                    errors = {i: e for i in range(len(batch))}
+            except Exception as e:
+                # Anything else (e.g. InvalidDocument) fails the whole batch; keep draining
+                errors = {i: e for i in range(len(batch))}
+            finally:
+                # Always settle every caller, or they (and stop()) would wait forever
+                for i, (_, future) in enumerate(batch):
+                    if not future.done():
+                        if i in errors:
+                            future.set_exception(errors[i])
+                        elif written:
+                            future.set_result(None)
+                        else:
+                            future.cancel()
+                    self._queue.task_done()
+
+_writers: Dict[str, BulkWriter] = {}
+
+def bulk_writer(collection_name: str) -> BulkWriter:
+    """The process-wide BulkWriter for a collection"""
+    writer = _writers.get(collection_name)
+    if writer is None:
+        writer = _writers[collection_name] = BulkWriter(collection_name)
+    return writer
+
+async def stop_writers():
+    """Flush and stop every BulkWriter (call from app shutdown, before close())"""
+    await asyncio.gather(*(writer.stop() for writer in _writers.values()))
 
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -40,16 +185,33 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     data_dict['created_at'] = datetime.now(timezone.utc)
     data_dict['updated_at'] = datetime.now(timezone.utc)
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
-    """Get documents from collection"""
+def find_documents(collection_name: str, filter_dict: dict = None, limit: int = None,
+                   after: Optional[ObjectId] = None, batch_size: int = 100):
+    """Cursor over a collection in _id order, starting after the `after` id (keyset pagination)"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
     
-    cursor = db[collection_name].find(filter_dict or {})
+    filter_dict = dict(filter_dict or {})
+    if after is not None:
+        filter_dict["_id"] = {"$gt": after}
+    cursor = db[collection_name].find(filter_dict).sort("_id", 1).batch_size(batch_size)
     if limit:
         cursor = cursor.limit(limit)
-    
-    return list(cursor)
+    return cursor
+
+async def run_in_transaction(callback: Callable[..., Awaitable[T]]) -> T:
+    """Run callback(session) inside a multi-document transaction.
+
+    Delegates to the driver's with_transaction, which retries the whole body on
+    TransientTransactionError and the commit on UnknownTransactionCommitResult,
+    so a commit of unknown outcome is never reported as a failure. Any other
+    exception aborts and propagates.
+    """
+    if client is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback)
@@ -1,14 +1,39 @@
+import asyncio
+import logging
 import os
-from fastapi import FastAPI, HTTPException
+import re
+import time
+import orjson
+from datetime import datetime, timezone
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import NamedTuple, Optional
+from async_lru import alru_cache
 from bson import ObjectId
+from pymongo import InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
 
-from database import db, create_document, get_documents
-from schemas import Course, Purchase, CourseToken, Balance, Order, User
+import database
+from database import db, bulk_writer, create_document, find_documents, run_in_transaction
+from open_orders import OpenOrder, OpenOrderCache
+from schemas import Course, Purchase, CourseToken, Order, User
 
-app = FastAPI(title="Course Token Marketplace API")
+def _json_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+class MongoJSONResponse(ORJSONResponse):
+    """orjson-encoded responses that also accept ObjectId"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Course Token Marketplace API", default_response_class=MongoJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,22 +43,123 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# List endpoints return at most MAX_PAGE_SIZE documents per request
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Open orders are cached by id; the order collection stays the durable record
+open_orders = OpenOrderCache()
+
+@app.on_event("startup")
+async def startup():
+    # Load the open-order cache only when the database answered, so /test still comes up without it
+    if await database.connect():
+        try:
+            open_orders.load(await db.order.find(
+                {"status": "open", "amount": {"$gt": 0}}, OpenOrder.PROJECTION
+            ).to_list(length=None))
+        except PyMongoError:
+            logger.exception("Failed to load open orders")
+
+@app.on_event("shutdown")
+async def shutdown():
+    await database.stop_writers()
+    database.close()
+
 # Utilities
+_OID_RE = re.compile(r"[0-9a-fA-F]{24}")
+
 class ObjectIdStr(str):
     @staticmethod
     def to_obj(id_str: str):
-        try:
-            return ObjectId(id_str)
-        except Exception:
+        # Pre-validate so the common (valid) case never sets up an exception
+        if not isinstance(id_str, str) or not _OID_RE.fullmatch(id_str):
             raise HTTPException(status_code=400, detail="Invalid id")
+        return ObjectId(id_str)
+
+def stream_page(collection_name: str, q: dict, limit: int, after: Optional[str]) -> StreamingResponse:
+    """One keyset page of a collection, encoded row by row as the cursor advances.
+
+    The body is {"items": [...], "next": cursor}; `next` is the `after` value for
+    the following page, or null once the collection is exhausted.
+    """
+    cursor = find_documents(collection_name, q, limit=limit, after=ObjectIdStr.to_obj(after) if after else None)
+
+    async def rows():
+        yield b'{"items":['
+        count, last_id = 0, None
+        async for doc in cursor:
+            yield (b"," if count else b"") + orjson.dumps(
+                doc, default=_json_default, option=orjson.OPT_NON_STR_KEYS
+            )
+            count, last_id = count + 1, doc["_id"]
+        # The cursor is only known once the last row is out, so it trails the items
+        next_cursor = str(last_id) if count == limit else None
+        yield b'],"next":' + orjson.dumps(next_cursor) + b"}"
+
+    return StreamingResponse(rows(), media_type="application/json")
+
+def purchase_allocation(total_supply: int) -> int:
+    # Tokenomics: allocate a fixed amount of tokens per course purchase to buyer from treasury
+    # For demo, 1% of total supply per purchase or at least 1 token
+    return max(1, int(total_supply * 0.01))
+
+class CourseMeta(NamedTuple):
+    price_usd: float
+    total_supply: int
+    token_symbol: str
+    allocate_per_purchase: int
+
+@alru_cache(maxsize=4096)
+async def course_meta(course_id: str) -> CourseMeta:
+    """Immutable course fields, cached per course. Raises (uncached) if the course is missing.
+
+    Nothing mutates these fields after creation; a route that does must call
+    course_meta.cache_invalidate(course_id).
+    """
+    # One round-trip for the course and its token record
+    rows = await db.course.aggregate([
+        {"$match": {"_id": ObjectIdStr.to_obj(course_id)}},
+        {"$lookup": {
+            "from": "coursetoken",
+            "let": {"cid": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$course_id", "$$cid"]}}},
+                {"$project": {"total_supply": 1, "allocate_per_purchase": 1}},
+            ],
+            "as": "token",
+        }},
+        {"$project": {
+            "price_usd": 1,
+            "token_symbol": 1,
+            "total_supply": {"$first": "$token.total_supply"},
+            "allocate_per_purchase": {"$first": "$token.allocate_per_purchase"},
+        }},
+    ]).to_list(length=1)
+    if not rows:
+        raise HTTPException(404, "Course not found")
+    course = rows[0]
+    if course.get("total_supply") is None:
+        raise HTTPException(500, "Token record missing for course")
+    total_supply = int(course["total_supply"])
+    allocate = course.get("allocate_per_purchase")
+    return CourseMeta(
+        price_usd=float(course.get("price_usd", 0)),
+        total_supply=total_supply,
+        token_symbol=course.get("token_symbol", ""),
+        # Token records created before allocate_per_purchase existed lack the field
+        allocate_per_purchase=int(allocate) if allocate is not None else purchase_allocation(total_supply),
+    )
 
 # Health
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Course Token Marketplace API"}
 
-@app.get("/test")
-def test_database():
+HEALTH_TTL_SECONDS = 10.0
+_HEALTH_CACHE = {"ts": 0.0, "val": None, "task": None}
+
+async def _refresh_health() -> dict:
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -49,82 +175,78 @@ def test_database():
             response["database_name"] = db.name
             response["connection_status"] = "Connected"
             try:
-                response["collections"] = db.list_collection_names()
+                response["collections"] = await db.list_collection_names()
             except Exception:
                 pass
         else:
             response["database"] = "⚠️  Available but not initialized"
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:80]}"
+    _HEALTH_CACHE.update(ts=time.monotonic(), val=response, task=None)
     return response
 
+@app.get("/test")
+async def test_database():
+    # Uptime checks scrape this constantly: serve a cached report and refresh it in the background once stale
+    if _HEALTH_CACHE["val"] is None:
+        return await _refresh_health()
+    if time.monotonic() - _HEALTH_CACHE["ts"] > HEALTH_TTL_SECONDS and _HEALTH_CACHE["task"] is None:
+        _HEALTH_CACHE["task"] = asyncio.create_task(_refresh_health())
+    return _HEALTH_CACHE["val"]
+
 # ==== Users (simple creator/buyer registry) ====
 @app.post("/api/users", response_model=dict)
-def create_user(user: User):
-    user_id = create_document("user", user)
+async def create_user(user: User):
+    user_id = await create_document("user", user)
     return {"id": user_id}
 
-@app.get("/api/users", response_model=List[dict])
-def list_users():
-    return get_documents("user")
+@app.get("/api/users", response_model=dict)
+async def list_users(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: Optional[str] = None
+):
+    return stream_page("user", {}, limit, after)
 
 # ==== Courses ====
 @app.post("/api/courses", response_model=dict)
-def create_course(course: Course):
+async def create_course(course: Course):
     # also create the course token record with full supply in treasury by default
-    course_id = create_document("course", course)
+    course_id = await create_document("course", course)
     token_record = CourseToken(
-        course_id=course_id,
+        course_id=ObjectId(course_id),
         token_symbol=course.token_symbol,
         total_supply=course.token_supply,
         circulating_supply=0,
         treasury_eth_address=course.treasury_eth_address,
         treasury_token_balance=course.token_supply,
         treasury_revenue_usd=0.0,
+        allocate_per_purchase=purchase_allocation(course.token_supply),
     )
-    create_document("coursetoken", token_record)
+    await create_document("coursetoken", token_record)
     return {"id": course_id}
 
-@app.get("/api/courses", response_model=List[dict])
-def list_courses():
-    return get_documents("course")
+@app.get("/api/courses", response_model=dict)
+async def list_courses(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: Optional[str] = None
+):
+    return stream_page("course", {}, limit, after)
 
-@app.get("/api/courses/{course_id}", response_model=dict)
-def get_course(course_id: str):
-    course = db.course.find_one({"_id": ObjectIdStr.to_obj(course_id)})
+@app.get("/api/courses/{course_id}")
+async def get_course(course_id: str):
+    course = await db.course.find_one({"_id": ObjectIdStr.to_obj(course_id)})
     if not course:
         raise HTTPException(404, "Course not found")
-    token = db.coursetoken.find_one({"course_id": course_id})
-    course["token"] = token
-    return course
+    course["token"] = await db.coursetoken.find_one({"course_id": course["_id"]})
+    # Returned directly so orjson encodes the ObjectIds and datetimes, not jsonable_encoder
+    return MongoJSONResponse(course)
 
 # ==== Purchases (buy course, reward tokens to buyer) ====
 class PurchaseRequest(BaseModel):
     user_id: str
 
-@app.post("/api/courses/{course_id}/purchase", response_model=dict)
-def purchase_course(course_id: str, req: PurchaseRequest):
-    course = db.course.find_one({"_id": ObjectIdStr.to_obj(course_id)})
-    if not course:
-        raise HTTPException(404, "Course not found")
-    token = db.coursetoken.find_one({"course_id": course_id})
-    if not token:
-        raise HTTPException(500, "Token record missing for course")
-
-    price = float(course.get("price_usd", 0))
-
-    # Record purchase
-    purchase = Purchase(user_id=req.user_id, course_id=course_id, price_usd=price)
-    purchase_id = create_document("purchase", purchase)
-
-    # Tokenomics: allocate a fixed amount of tokens per course purchase to buyer from treasury
-    # For demo, 1% of total supply per purchase or at least 1 token
-    allocate = max(1, int(token.get("total_supply", 1000) * 0.01))
-    if token.get("treasury_token_balance", 0) < allocate:
-        allocate = token.get("treasury_token_balance", 0)
-    
-    db.coursetoken.update_one(
-        {"course_id": course_id},
+async def debit_treasury(course_id: ObjectId, allocate: int, price: float) -> int:
+    """Atomically move up to `allocate` tokens out of the treasury; returns the amount moved"""
+    res = await db.coursetoken.update_one(
+        {"course_id": course_id, "treasury_token_balance": {"$gte": allocate}},
         {
             "$inc": {
                 "circulating_supply": allocate,
@@ -133,86 +255,183 @@ def purchase_course(course_id: str, req: PurchaseRequest):
             }
         },
     )
+    if res.matched_count:
+        return allocate
+
+    # Treasury nearly depleted: hand out whatever is left
+    before = await db.coursetoken.find_one_and_update(
+        {"course_id": course_id},
+        [{
+            "$set": {
+                "circulating_supply": {"$add": ["$circulating_supply", "$treasury_token_balance"]},
+                "treasury_token_balance": 0,
+                "treasury_revenue_usd": {"$add": ["$treasury_revenue_usd", price]},
+            }
+        }],
+        projection={"treasury_token_balance": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if not before:
+        raise HTTPException(500, "Token record missing for course")
+    return max(0, before.get("treasury_token_balance", 0))
+
+@app.post("/api/courses/{course_id}/purchase", response_model=dict)
+async def purchase_course(course_id: str, req: PurchaseRequest):
+    meta = await course_meta(course_id)
+    price = meta.price_usd
+    allocate = meta.allocate_per_purchase
+
+    # Record purchase (batched with concurrent purchases) before touching the treasury,
+    # so a failed insert never leaves debited tokens without a holder
+    now = datetime.now(timezone.utc)
+    purchase = Purchase(user_id=req.user_id, course_id=course_id, price_usd=price).model_dump()
+    purchase.update(_id=ObjectId(), created_at=now, updated_at=now)
+    await bulk_writer("purchase").write(InsertOne(purchase))
+    allocate = await debit_treasury(ObjectId(course_id), allocate, price)
 
     # Credit buyer balance
-    bal = db.balance.find_one({"user_id": req.user_id, "course_id": course_id})
-    if bal:
-        db.balance.update_one({"_id": bal["_id"]}, {"$inc": {"amount": allocate}})
-    else:
-        create_document("balance", Balance(user_id=req.user_id, course_id=course_id, amount=allocate))
+    await bulk_writer("balance").write(UpdateOne(
+        {"user_id": req.user_id, "course_id": course_id},
+        {"$inc": {"amount": allocate}, "$set": {"updated_at": now}, "$setOnInsert": {"reserved": 0, "created_at": now}},
+        upsert=True,
+    ))
 
-    return {"purchase_id": purchase_id, "tokens_awarded": allocate, "price_usd": price}
+    return {"purchase_id": str(purchase["_id"]), "tokens_awarded": allocate, "price_usd": price}
 
 # ==== Simple Orderbook for token trading (off-chain demo) ====
 @app.post("/api/orders", response_model=dict)
-def place_order(order: Order):
+async def place_order(order: Order):
     # validate course exists
-    course = db.course.find_one({"_id": ObjectIdStr.to_obj(order.course_id)})
-    if not course:
-        raise HTTPException(404, "Course not found")
+    await course_meta(order.course_id)
 
-    # if selling, ensure user balance
+    # if selling, lock tokens by moving them to the reserved field, provided the balance covers them
     if order.side == "sell":
-        bal = db.balance.find_one({"user_id": order.user_id, "course_id": order.course_id})
-        if not bal or int(bal.get("amount", 0)) < order.amount:
+        bal = await db.balance.find_one_and_update(
+            {"user_id": order.user_id, "course_id": order.course_id, "amount": {"$gte": order.amount}},
+            {"$inc": {"amount": -order.amount, "reserved": order.amount}},
+            projection={"_id": 1},
+        )
+        if not bal:
             raise HTTPException(400, "Insufficient token balance")
-        # lock tokens by moving to reserved field
-        db.balance.update_one({"_id": bal["_id"]}, {"$inc": {"amount": -order.amount, "reserved": order.amount}})
 
-    order_id = create_document("order", order)
-    return {"id": order_id}
+    now = datetime.now(timezone.utc)
+    doc = order.model_dump()
+    doc.update(_id=ObjectId(), created_at=now, updated_at=now)
+    try:
+        await db.order.insert_one(doc)
+    except Exception:
+        # No order to back the reservation: hand the tokens back
+        if order.side == "sell":
+            await db.balance.update_one(
+                {"user_id": order.user_id, "course_id": order.course_id},
+                {"$inc": {"amount": order.amount, "reserved": -order.amount}},
+            )
+        raise
+    open_orders.add(OpenOrder.from_document(doc))
+    return {"id": str(doc["_id"])}
 
-@app.get("/api/orders", response_model=List[dict])
-def list_orders(course_id: Optional[str] = None, side: Optional[str] = None):
+@app.get("/api/orders", response_model=dict)
+async def list_orders(
+    course_id: Optional[str] = None,
+    side: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+):
     q = {}
     if course_id:
         q["course_id"] = course_id
     if side:
         q["side"] = side
-    return get_documents("order", q, limit=100)
+    return stream_page("order", q, limit, after)
 
 class TradeRequest(BaseModel):
     buy_order_id: str
     sell_order_id: str
-    amount: int
+    amount: int = Field(..., gt=0)
 
 @app.post("/api/trades", response_model=dict)
-def match_trade(req: TradeRequest):
-    buy = db.order.find_one({"_id": ObjectIdStr.to_obj(req.buy_order_id)})
-    sell = db.order.find_one({"_id": ObjectIdStr.to_obj(req.sell_order_id)})
+async def match_trade(req: TradeRequest):
+    buy_oid = ObjectIdStr.to_obj(req.buy_order_id)
+    sell_oid = ObjectIdStr.to_obj(req.sell_order_id)
+
+    # Open orders are usually cached; misses are read from the collection and cached
+    # while they still have quantity left
+    fetched = {}
+    missing = [oid for oid in (buy_oid, sell_oid) if open_orders.get(oid) is None]
+    if missing:
+        async for doc in db.order.find({"_id": {"$in": missing}}, {**OpenOrder.PROJECTION, "status": 1}):
+            if doc.get("status", "open") != "open":
+                doc["amount"] = 0
+            fetched[doc["_id"]] = order = OpenOrder.from_document(doc)
+            if order.amount > 0:
+                open_orders.add(order)
+    buy = open_orders.get(buy_oid) or fetched.get(buy_oid)
+    sell = open_orders.get(sell_oid) or fetched.get(sell_oid)
     if not buy or not sell:
         raise HTTPException(404, "Order not found")
-    if buy["side"] != "buy" or sell["side"] != "sell":
+    if buy.side != "buy" or sell.side != "sell":
         raise HTTPException(400, "Invalid order sides")
-    if buy["course_id"] != sell["course_id"]:
+    if buy.course_id != sell.course_id:
         raise HTTPException(400, "Course mismatch")
 
-    amount = min(req.amount, buy["amount"], sell["amount"])  # partial fills allowed
-    price = sell["price_usd"]  # simple: execute at sell price
-
-    # Update open quantities
-    db.order.update_one({"_id": sell["_id"]}, {"$inc": {"amount": -amount}})
-    db.order.update_one({"_id": buy["_id"]}, {"$inc": {"amount": -amount}})
+    amount = min(req.amount, buy.amount, sell.amount)  # partial fills allowed
+    price = sell.price_usd  # simple: execute at sell price
+    course_id = buy.course_id
+    if amount <= 0:
+        return {"filled_amount": 0, "price_usd": price}
 
-    # Release seller reserved and transfer to buyer
-    bal_seller = db.balance.find_one({"user_id": sell["user_id"], "course_id": sell["course_id"]})
-    if not bal_seller:
-        db.balance.insert_one({"user_id": sell["user_id"], "course_id": sell["course_id"], "amount": 0, "reserved": 0})
-        bal_seller = db.balance.find_one({"user_id": sell["user_id"], "course_id": sell["course_id"]})
-    db.balance.update_one({"_id": bal_seller["_id"]}, {"$inc": {"reserved": -amount}})
+    # Update open quantities in the cache before yielding to other requests
+    open_orders.fill(sell, amount)
+    open_orders.fill(buy, amount)
 
-    bal_buyer = db.balance.find_one({"user_id": buy["user_id"], "course_id": buy["course_id"]})
-    if bal_buyer:
-        db.balance.update_one({"_id": bal_buyer["_id"]}, {"$inc": {"amount": amount}})
-    else:
-        db.balance.insert_one({"user_id": buy["user_id"], "course_id": buy["course_id"], "amount": amount})
+    async def settle(session):
+        # The collection, not the cache, decides whether both orders can still take the fill
+        res = await db.order.bulk_write([
+            UpdateOne({"_id": sell.id, "amount": {"$gte": amount}}, {"$inc": {"amount": -amount}}),
+            UpdateOne({"_id": buy.id, "amount": {"$gte": amount}}, {"$inc": {"amount": -amount}}),
+        ], ordered=False, session=session)
+        if res.matched_count != 2:
+            raise HTTPException(409, "Order no longer has enough open quantity")
+        # Release seller reserved and transfer to buyer
+        await db.balance.bulk_write([
+            UpdateOne(
+                {"user_id": sell.user_id, "course_id": course_id},
+                {"$inc": {"reserved": -amount}, "$setOnInsert": {"amount": 0}},
+                upsert=True,
+            ),
+            UpdateOne(
+                {"user_id": buy.user_id, "course_id": course_id},
+                {"$inc": {"amount": amount}, "$setOnInsert": {"reserved": 0}},
+                upsert=True,
+            ),
+        ], ordered=False, session=session)
+        # Track treasury revenue for secondary market fee example (optional small fee)
+        await db.coursetoken.update_one(
+            {"course_id": ObjectId(course_id)},
+            {"$inc": {"treasury_revenue_usd": amount * price * 0.005}},
+            session=session,
+        )
 
-    # Track treasury revenue for secondary market fee example (optional small fee)
-    db.coursetoken.update_one({"course_id": buy["course_id"]}, {"$inc": {"treasury_revenue_usd": amount * price * 0.005}})
+    # Orders, balances and treasury commit together or not at all
+    try:
+        await run_in_transaction(settle)
+    except HTTPException:
+        # The cached quantities were stale: drop them so the next trade rereads both orders
+        open_orders.discard(sell)
+        open_orders.discard(buy)
+        raise
+    except Exception:
+        open_orders.unfill(sell, amount)
+        open_orders.unfill(buy, amount)
+        raise
 
     return {"filled_amount": amount, "price_usd": price}
 
 # ==== Balances ====
-@app.get("/api/balances/{user_id}", response_model=List[dict])
-def get_user_balances(user_id: str):
-    return get_documents("balance", {"user_id": user_id})
+@app.get("/api/balances/{user_id}", response_model=dict)
+async def get_user_balances(
+    user_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+):
+    return stream_page("balance", {"user_id": user_id}, limit, after)
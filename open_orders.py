@@ -0,0 +1,69 @@
+"""
+In-memory cache of open orders
+
+Holds the open orders of every course in RAM, keyed by id, so matching a trade
+rarely has to read them from MongoDB. The `order` collection stays the durable
+record: inserts and fills are written before the request returns, and the cache
+is rebuilt from it at startup.
+"""
+
+from dataclasses import dataclass
+from typing import ClassVar, Dict, Iterable, Optional
+
+from bson import ObjectId
+
+@dataclass(eq=False)
+class OpenOrder:
+    id: ObjectId
+    course_id: str
+    user_id: str
+    side: str
+    price_usd: float
+    amount: int
+
+    # Fields from_document() reads; pass as the projection when loading orders
+    PROJECTION: ClassVar[Dict[str, int]] = {
+        "course_id": 1, "user_id": 1, "side": 1, "price_usd": 1, "amount": 1,
+    }
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "OpenOrder":
+        return cls(
+            id=doc["_id"],
+            course_id=doc["course_id"],
+            user_id=doc["user_id"],
+            side=doc["side"],
+            price_usd=doc["price_usd"],
+            amount=doc["amount"],
+        )
+
+class OpenOrderCache:
+    """Open orders by id"""
+
+    def __init__(self):
+        self.orders: Dict[ObjectId, OpenOrder] = {}
+
+    def get(self, order_id: ObjectId) -> Optional[OpenOrder]:
+        return self.orders.get(order_id)
+
+    def add(self, order: OpenOrder):
+        self.orders.setdefault(order.id, order)
+
+    def discard(self, order: OpenOrder):
+        self.orders.pop(order.id, None)
+
+    def load(self, docs: Iterable[dict]):
+        for doc in docs:
+            self.add(OpenOrder.from_document(doc))
+
+    def fill(self, order: OpenOrder, amount: int):
+        """Reduce an order's open quantity, dropping it from the cache once exhausted"""
+        order.amount -= amount
+        if order.amount <= 0:
+            self.orders.pop(order.id, None)
+
+    def unfill(self, order: OpenOrder, amount: int):
+        """Undo fill() when the trade it belonged to failed to persist"""
+        order.amount += amount
+        if order.amount > 0:
+            self.add(order)
@@ -5,10 +5,16 @@ Each Pydantic model corresponds to a MongoDB collection (lowercased class name).
 Use these models for validation in API routes.
 """
 
-from pydantic import BaseModel, Field
+from bson import ObjectId
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, Literal
 
+# Request/record models are never mutated after validation; unknown fields are dropped
+SCHEMA_CONFIG = ConfigDict(frozen=True, extra="ignore")
+
 class User(BaseModel):
+    model_config = SCHEMA_CONFIG
+
     name: str = Field(..., description="Display name")
     email: str = Field(..., description="Email address")
     role: Literal["creator", "buyer", "both"] = Field("both")
@@ -16,6 +22,8 @@ class User(BaseModel):
     is_active: bool = True
 
 class Course(BaseModel):
+    model_config = SCHEMA_CONFIG
+
     creator_id: str = Field(..., description="ID of the creator user")
     title: str
     description: str
@@ -28,26 +36,35 @@ class Course(BaseModel):
     treasury_eth_address: str = Field(..., description="ETH address where revenue accumulates")
 
 class Purchase(BaseModel):
+    model_config = SCHEMA_CONFIG
+
     user_id: str
     course_id: str
     price_usd: float
     status: Literal["paid", "refunded"] = "paid"
 
 class CourseToken(BaseModel):
-    course_id: str
+    model_config = ConfigDict(**SCHEMA_CONFIG, arbitrary_types_allowed=True)
+
+    course_id: ObjectId = Field(..., description="_id of the course")
     token_symbol: str
     total_supply: int
     circulating_supply: int = 0
     treasury_eth_address: str
     treasury_token_balance: int
     treasury_revenue_usd: float = 0.0
+    allocate_per_purchase: int = Field(..., gt=0, description="Tokens awarded per course purchase, fixed at creation")
 
 class Balance(BaseModel):
+    model_config = SCHEMA_CONFIG
+
     user_id: str
     course_id: str
     amount: int = 0
 
 class Order(BaseModel):
+    model_config = SCHEMA_CONFIG
+
     course_id: str
     user_id: str
     side: Literal["buy", "sell"]